@@ -0,0 +1,89 @@
+"""Client for the DuckDuckGo instant answer shown next to each question.
+
+Kept free of Flask so it can be pointed at a local stub server.
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CALLBACK = 'process_duckduckgo'
+
+
+class AnswerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.fetches = 0
+        self.failures = 0
+        self.upstream_seconds = 0.0
+        self.upstream_max = 0.0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self, stale = False):
+        with self.lock:
+            self.misses += 1
+            if stale:
+                self.stale += 1
+
+    def upstream(self, seconds, ok):
+        with self.lock:
+            self.fetches += 1
+            if not ok:
+                self.failures += 1
+            self.upstream_seconds += seconds
+            self.upstream_max = max(self.upstream_max, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'fetches': self.fetches,
+                'failures': self.failures,
+                'upstream_avg_ms': 1000 * self.upstream_seconds / self.fetches if self.fetches else None,
+                'upstream_max_ms': 1000 * self.upstream_max,
+            }
+
+
+class AnswerClient:
+    def __init__(self, url, headers, timeout, pool_size, stats):
+        self.url = url
+        self.headers = headers
+        self.timeout = timeout
+        self.stats = stats
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, question):
+        params = {"q": question, "format": "json", "skip_disambig": "1", "no_redirect": "1", "no_html": "1"}
+        start = time.perf_counter()
+        ok = False
+        try:
+            rv = self.session.get(self.url, headers = self.headers, params = params, timeout = self.timeout)
+            rv.raise_for_status()
+            answer = parse(rv.text)
+            ok = True
+            return answer
+        finally:
+            self.stats.upstream(time.perf_counter() - start, ok)
+
+
+def parse(text):
+    text = text.strip()
+    # the API can still answer as JSONP, e.g. process_duckduckgo({...});
+    if text.startswith(CALLBACK + '('):
+        text = text[len(CALLBACK) + 1:].rstrip(';').rstrip(')')
+    return json.loads(text).get("Abstract", "")
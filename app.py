@@ -1,4 +1,5 @@
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, request, render_template, redirect, url_for, flash, abort, jsonify, g, has_request_context, session
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_login import UserMixin, login_user, LoginManager, login_required, logout_user, current_user
@@ -6,19 +7,82 @@ from flask_wtf import FlaskForm
 from flask_bcrypt import Bcrypt
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import InputRequired, Length, ValidationError
-import base64
-import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from markupsafe import Markup, escape
+from werkzeug.exceptions import RequestEntityTooLarge
+from images import ImageError
+from answers import AnswerClient, AnswerStats
+from cache import make_cache
+from auth import HashPool, HasherBusy, RateLimiter, SessionUser
+import images
+import click
+import hashlib
 import json
+import math
+import multiprocessing
 import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
 
 app = Flask(__name__)
 CORS(app)
 
 courses = os.path.abspath(os.path.dirname(__file__)) 
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(courses, 'db.sqlite')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(courses, 'db.sqlite')).replace('postgres://', 'postgresql://', 1)
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['REQUIRE_CURRENT_SCHEMA'] = os.environ.get('REQUIRE_CURRENT_SCHEMA', '1') == '1'
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS') == '1'
+app.config['ENFORCE_QUERY_BUDGETS'] = os.environ.get('ENFORCE_QUERY_BUDGETS') == '1'
+app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'memory')
+app.config['FRAGMENT_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['FRAGMENT_CACHE_ITEMS'] = 10000
+# an in-process cache only hears about writes made in its own worker, so it
+# keeps fragments briefly; with several workers a shared redis:// URL lets
+# them all see every invalidation and the fragments can live much longer
+app.config['FRAGMENT_TTL'] = int(os.environ.get('FRAGMENT_TTL', 5 if app.config['FRAGMENT_CACHE'] == 'memory' else 60 * 5))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# hashes a worker process runs at once; keep it below the threads each
+# worker has so a login flood always leaves threads free for browsing, and
+# turn the flood away at once rather than queueing it
+app.config['AUTH_HASH_WORKERS'] = int(os.environ.get('AUTH_HASH_WORKERS', 1))
+app.config['AUTH_HASH_QUEUE'] = int(os.environ.get('AUTH_HASH_QUEUE', 0))
+app.config['LOGIN_IP_BURST'] = 10
+app.config['LOGIN_IP_RATE'] = 1 / 5
+app.config['LOGIN_USER_BURST'] = 5
+app.config['LOGIN_USER_RATE'] = 1 / 30
+app.config['SESSION_USER_CACHE'] = os.environ.get('SESSION_USER_CACHE', 'memory')
+app.config['SESSION_USER_TTL'] = 60 * 60
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'EldenRing'
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['MAX_IMAGE_BYTES'] = 8 * 1024 * 1024
+app.config['IMAGE_WORKERS'] = 2
+app.config['FEED_PAGE_SIZE'] = 20
+app.config['FEED_MAX_PAGE_SIZE'] = 100
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['ANSWER_API_URL'] = os.environ.get('ANSWER_API_URL', "https://duckduckgo-duckduckgo-zero-click-info.p.rapidapi.com/")
+app.config['ANSWER_API_KEY'] = os.environ.get('ANSWER_API_KEY', "8b160655abmshc5a082b7c4f87b7p1d935fjsn4a9e4e59e925")
+app.config['ANSWER_TIMEOUT'] = 2.0
+app.config['ANSWER_TTL'] = 60 * 60 * 24
+app.config['ANSWER_ERROR_TTL'] = 60 * 5
+app.config['ANSWER_WORKERS'] = 4
 
 salt = "SUPERSECRET" 
 
@@ -26,18 +90,118 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# the user is cached under the token handed out at login, so an
+# authenticated page view doesn't have to query the user table
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    token = session.get('auth_token')
+    key = 'user:%s:%s' % (user_id, token)
+    if token:
+        cached = session_users.get(key)
+        if cached is not None:
+            return SessionUser(**json.loads(cached))
+    user = db.session.get(User, int(user_id))
+    if user is not None and token:
+        session_users.set(key, json.dumps({'id': user.id, 'name': user.name, 'username': user.username}))
+    return user
+
+# rows are still read after commit (ids for redirects, cache keys), keep
+# them loaded instead of paying a refresh query each time
+db = SQLAlchemy(app, session_options = {'expire_on_commit': False})
+
+# several workers share one SQLite file: WAL lets readers run alongside the
+# writer and busy_timeout makes writers queue instead of failing as locked
+@db.event.listens_for(Engine, 'connect')
+def sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = %s' % app.config['SQLITE_JOURNAL_MODE'])
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = %d' % app.config['SQLITE_BUSY_TIMEOUT'])
+    cursor.execute('PRAGMA cache_size = -20000')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+# per-request profile: SQL count and time, template render time and total
+# time, kept on g and reported by profile_response()
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+def query_budget(limit):
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def query_started(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_started = time.perf_counter()
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def query_finished(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_started' in g:
+        g.query_count += 1
+        g.query_time += time.perf_counter() - g.pop('query_started')
+
+@before_render_template.connect_via(app)
+def render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def render_finished(sender, template, context, **extra):
+    g.render_time += time.perf_counter() - g.pop('render_started', time.perf_counter())
+
+@app.before_request
+def profile_request():
+    g.request_started = time.perf_counter()
+    g.query_count, g.query_time, g.render_time = 0, 0.0, 0.0
+
+@app.after_request
+def profile_response(rv):
+    total = time.perf_counter() - g.request_started
+    if app.config['PROFILE_REQUESTS']:
+        rv.headers['X-Query-Count'] = str(g.query_count)
+        rv.headers['Server-Timing'] = 'sql;desc="%d queries";dur=%.2f, render;dur=%.2f, total;dur=%.2f' % (
+            g.query_count, g.query_time * 1000, g.render_time * 1000, total * 1000)
+        app.logger.info("%s %s %s: %d queries in %.1fms, render %.1fms, total %.1fms", request.method, request.path,
+                        rv.status_code, g.query_count, g.query_time * 1000, g.render_time * 1000, total * 1000)
+    budget = getattr(app.view_functions.get(request.endpoint), 'query_budget', None)
+    if budget is not None and g.query_count > budget:
+        message = "%s ran %d queries, budget is %d" % (request.endpoint, g.query_count, budget)
+        if app.config['ENFORCE_QUERY_BUDGETS']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return rv
 
-db = SQLAlchemy(app)
 bcrypt = Bcrypt(app) 
+# workers are started from a clean forkserver process, or spawned where there
+# is none (Windows); forking this one would copy whatever locks the answer and
+# hash threads happen to hold
+image_start = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+image_pool = ProcessPoolExecutor(max_workers = app.config['IMAGE_WORKERS'], mp_context = multiprocessing.get_context(image_start))
+answer_pool = ThreadPoolExecutor(max_workers = app.config['ANSWER_WORKERS'])
+answer_stats = AnswerStats()
+answer_client = AnswerClient(app.config['ANSWER_API_URL'], {
+        "X-RapidAPI-Key": app.config['ANSWER_API_KEY'],
+        "X-RapidAPI-Host": "duckduckgo-duckduckgo-zero-click-info.p.rapidapi.com"
+    }, app.config['ANSWER_TIMEOUT'], app.config['ANSWER_WORKERS'], answer_stats)
+answer_pending = set()
+answer_lock = threading.Lock()
+hash_pool = HashPool(app.config['AUTH_HASH_WORKERS'], app.config['AUTH_HASH_QUEUE'])
+login_ip_limit = RateLimiter(app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_RATE'])
+login_user_limit = RateLimiter(app.config['LOGIN_USER_BURST'], app.config['LOGIN_USER_RATE'])
+session_users = make_cache(app.config['SESSION_USER_CACHE'], 4 * 1024 * 1024, 10000, app.config['SESSION_USER_TTL'])
+fragments = make_cache(app.config['FRAGMENT_CACHE'], app.config['FRAGMENT_CACHE_BYTES'],
+                       app.config['FRAGMENT_CACHE_ITEMS'], app.config['FRAGMENT_TTL'])
 
 class Vote(db.Model):
+    __table_args__ = (db.Index('ix_vote_user_reply', 'user_id', 'replies_id', unique = True),)
     id = db.Column(db.Integer, primary_key = True)
     choice = db.Column(db.String, nullable = False)
     user_id = db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
-    replies_id = db.Column('replies_id', db.Integer, db.ForeignKey('replies.id'))
+    replies_id = db.Column('replies_id', db.Integer, db.ForeignKey('replies.id'), index = True)
     replies = db.relationship('Replies', back_populates = 'user_votes')
     user = db.relationship('User', back_populates = 'post_votes')
 
@@ -45,7 +209,9 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String)
     posts = db.Column(db.Text)
-    data = db.Column(db.LargeBinary, nullable = False) 
+    data = db.deferred(db.Column(db.LargeBinary, nullable = False, default = b''))
+    image = db.Column(db.String(64), db.ForeignKey('blob.sha256'))
+    thumb = db.Column(db.String(64), db.ForeignKey('blob.sha256'))
     reply = db.relationship('Replies', backref = 'post')
 
 class User(db.Model, UserMixin):
@@ -60,9 +226,28 @@ class Replies(db.Model):
     posts = db.Column(db.Text)
     name = db.Column(db.String)
     likes = db.Column(db.Integer)
-    data = db.Column(db.LargeBinary, nullable = False)
-    response = db.Column(db.Integer, db.ForeignKey('post.id'))
+    data = db.deferred(db.Column(db.LargeBinary, nullable = False, default = b''))
+    image = db.Column(db.String(64), db.ForeignKey('blob.sha256'))
+    thumb = db.Column(db.String(64), db.ForeignKey('blob.sha256'))
+    response = db.Column(db.Integer, db.ForeignKey('post.id'), index = True)
     user_votes = db.relationship('Vote', back_populates='replies')
+
+# processed images are stored once, keyed by the sha256 of their bytes;
+# source is the sha256 of the upload they came from so repeats skip the resize
+class Blob(db.Model):
+    sha256 = db.Column(db.String(64), primary_key = True)
+    source = db.Column(db.String(64), index = True)
+    kind = db.Column(db.String, nullable = False)
+    mimetype = db.Column(db.String, nullable = False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    data = db.deferred(db.Column(db.LargeBinary, nullable = False))
+
+# cached web answers, keyed by the sha256 of the normalised question text
+class Answer(db.Model):
+    key = db.Column(db.String(64), primary_key = True)
+    answer = db.Column(db.Text, nullable = False)
+    expires = db.Column(db.Float, nullable = False)
     
 class RegisterForm(FlaskForm):
     name = StringField(validators = [InputRequired(), Length(min = 4, max = 20)], render_kw={"placeholder" : "name"})
@@ -76,10 +261,18 @@ class RegisterForm(FlaskForm):
             raise ValidationError("That username already exists. Please choose a different one.") 
 
 @app.route('/register', methods = ['GET', 'POST'])
+@query_budget(3)
 def register():
+    if request.method == 'POST':
+        wait = login_ip_limit.take('register:%s' % request.remote_addr)
+        if wait:
+            return refuse(429, wait, "Too many attempts, please wait a moment and try again.")
     form = RegisterForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data + salt)
+        try:
+            hashed_password = hash_pool.run(bcrypt.generate_password_hash, form.password.data + salt)
+        except HasherBusy:
+            return refuse(503, 1, "The server is busy, please try again.")
         new_user = User(name = form.name.data, username = form.username.data, password = hashed_password)
         db.session.add(new_user)
         db.session.commit()
@@ -87,20 +280,37 @@ def register():
     return render_template('Register.html', form = form)
 
 @app.route('/login', methods = ['GET', 'POST'])
+@query_budget(2)
 def login():
+    if request.method == 'POST':
+        # checked before the form is even built; the username bucket is only
+        # charged once the address passes, so a client that is already being
+        # refused can't spend another account's attempts
+        wait = login_ip_limit.take(request.remote_addr) or login_user_limit.take(request.form.get('username', '').lower())
+        if wait:
+            return refuse(429, wait, "Too many login attempts, please wait a moment and try again.")
     form = LoginForm()
     if form.validate_on_submit():
-        if User.query.filter_by(username = form.username.data).first():
-            user = User.query.filter_by(username = form.username.data).first()
+        user = User.query.filter_by(username = form.username.data).first()
         if user:
-            if bcrypt.check_password_hash(user.password, form.password.data + salt):
+            try:
+                matched = hash_pool.run(bcrypt.check_password_hash, user.password, form.password.data + salt)
+            except HasherBusy:
+                return refuse(503, 1, "The server is busy, please try again.")
+            if matched:
                 login_user(user)
+                session['auth_token'] = uuid.uuid4().hex
                 return redirect(url_for('dashboard'))
     return render_template('login.html', form = form)
 
+# kept to a bare text response: during a flood this is the hot path
+def refuse(status, wait, message):
+    return app.response_class(message, status, {'Retry-After': str(math.ceil(wait))}, mimetype = 'text/plain')
+
 @app.route('/logout', methods = ['GET', 'POST'])
 @login_required
 def logout():
+    session_users.delete('user:%s:%s' % (current_user.id, session.pop('auth_token', None)))
     logout_user()
     return redirect(url_for('login'))
 
@@ -115,115 +325,406 @@ def aboot():
 
 @app.route('/dashboard', methods = ['GET', 'POST'])
 @login_required
+@query_budget(4)
 def dashboard():
     if(request.method == 'GET'):
-        preguntas = Post.query.all()
-        imagestuff = [base64.b64encode(image.data).decode("utf-8") for image in preguntas]
-        return render_template('dashboard.html', preguntas = preguntas, images = imagestuff)
+        limit = request.args.get('limit', app.config['FEED_PAGE_SIZE'], type = int)
+        limit = max(1, min(limit, app.config['FEED_MAX_PAGE_SIZE']))
+        before, after = request.args.get('before', type = int), request.args.get('after', type = int)
+        if request.args.get('format') == 'json':
+            preguntas, newer, older = feed_page(before, after, limit)
+            counts = reply_counts([something.id for something in preguntas])
+            return jsonify(
+                posts = [feed_item(something, counts.get(something.id, 0)) for something in preguntas],
+                newer = newer and url_for('dashboard', after = newer, limit = limit, format = 'json'),
+                older = older and url_for('dashboard', before = older, limit = limit, format = 'json'))
+        feed = fragment('feed:%s:%s:%s:%d' % (generation('feed:gen'), before, after, limit), partial(render_feed, before, after, limit))
+        return render_template('dashboard.html', feed = Markup(feed))
     elif(request.method == 'POST'):
         post = request.form['askquestion']
-        file = request.files['imageFile']
-        data = file.read()
-        stuff = User.query.filter_by(id = current_user.id).first()
-        input = Post(posts = post, name = stuff.name, data=data)
+        try:
+            upload = read_upload(request.files.get('imageFile'))
+        except ImageError as e:
+            flash(str(e), "error")
+            return redirect(url_for('dashboard'))
+        input = Post(posts = post, name = current_user.name)
         db.session.add(input)
         db.session.commit()
+        fragments.delete('feed:gen')
+        note_write()
+        queue_image(input, upload)
         return redirect(url_for('dashboard'))
 
+# rendered fragments shared by every viewer; anything that depends on the
+# logged-in user stays in the page templates around them. Someone who just
+# wrote skips the cache until it has caught up, whichever worker they land on
+def fragment(key, build):
+    value = None if wrote_recently() else fragments.get(key)
+    if value is None:
+        value = build()
+        fragments.set(key, value)
+    return value
 
-@app.route('/response/<int:question_id>', methods = ['GET', 'POST'])
-@login_required
-def response(question_id):
+def note_write():
+    session['wrote_at'] = time.time()
+
+def wrote_recently():
+    return session.get('wrote_at', 0) > time.time() - app.config['FRAGMENT_TTL']
+
+# fragments are keyed by a generation token, feed:gen for the feed and
+# thread:<id> for a question and its replies; deleting the token retires
+# everything built under it, and a render that was already in flight when
+# the write landed can only fill a key that nobody reads any more
+def generation(name):
+    token = fragments.get(name)
+    if token is None:
+        token = uuid.uuid4().hex
+        fragments.set(name, token)
+    return token
+
+# read before the commit that changes the row, deleted after it
+def fragment_keys(row):
+    if isinstance(row, Post):
+        return ['thread:%d' % row.id, 'feed:gen']
+    return ['thread:%d' % row.response]
+
+def render_feed(before, after, limit):
+    preguntas, newer, older = feed_page(before, after, limit)
+    counts = reply_counts([something.id for something in preguntas])
+    return render_template('_feed.html', preguntas = preguntas, counts = counts, newer = newer, older = older, limit = limit)
+
+def render_question(question_id):
     questions = Post.query.get_or_404(question_id)
+    return json.dumps({'id': questions.id, 'posts': questions.posts, 'name': questions.name,
+                       'html': render_template('_question.html', questions = questions)})
+
+def render_replies(question_id):
     replys = Replies.query.filter_by(response = question_id).all()
-    # answer = people_also_ask.get_answer(questions.posts)
-    
-    url = "https://duckduckgo-duckduckgo-zero-click-info.p.rapidapi.com/"
-    querystring = {"q":questions.posts,"format":"json","skip_disambig":"1","no_redirect":"1","no_html":"1","callback":"process_duckduckgo"}
-    headers = {
-        "X-RapidAPI-Key": "8b160655abmshc5a082b7c4f87b7p1d935fjsn4a9e4e59e925",
-        "X-RapidAPI-Host": "duckduckgo-duckduckgo-zero-click-info.p.rapidapi.com"
+    return render_template('_replies.html', replys = replys)
+
+# newest first, paged on Post.id so every page costs the same no matter how
+# deep it is; returns the rows plus the cursors for the neighbouring pages
+def feed_page(before, after, limit):
+    if after is not None:
+        rows = Post.query.filter(Post.id > after).order_by(Post.id.asc()).limit(limit + 1).all()
+        has_newer, has_older = len(rows) > limit, True
+        rows = rows[:limit][::-1]
+    else:
+        query = Post.query
+        if before is not None:
+            query = query.filter(Post.id < before)
+        rows = query.order_by(Post.id.desc()).limit(limit + 1).all()
+        has_newer, has_older = before is not None, len(rows) > limit
+        rows = rows[:limit]
+    if not rows:
+        return rows, None, None
+    return rows, rows[0].id if has_newer else None, rows[-1].id if has_older else None
+
+def reply_counts(post_ids):
+    if not post_ids:
+        return {}
+    counts = db.session.query(Replies.response, db.func.count(Replies.id)).filter(Replies.response.in_(post_ids)).group_by(Replies.response)
+    return dict(counts.all())
+
+def feed_item(post, replies):
+    return {
+        'id': post.id,
+        'name': post.name,
+        'posts': post.posts,
+        'replies': replies,
+        'url': url_for('response', question_id = post.id),
+        'image': post.image and url_for('media', digest = post.image),
+        'thumb': post.thumb and url_for('media', digest = post.thumb),
     }
-    response = requests.request("GET", url, headers=headers, params=querystring)
-    res = response.text
-    res1 = res.lstrip("process_duckduckgo(")
-    res2 = res1.strip("();")
-    res3 = json.loads(res2)
-    answer = res3["Abstract"]
+
+@app.route('/response/<int:question_id>', methods = ['GET', 'POST'])
+@login_required
+@query_budget(4)
+def response(question_id):
     if(request.method == 'GET'):
-        imagestuff = [base64.b64encode(image.data).decode("utf-8") for image in replys]
-        return render_template('response.html', questions = questions, replys = replys, answer=answer, images = imagestuff)
+        thread = generation('thread:%d' % question_id)
+        questions = json.loads(fragment('question:%d:%s' % (question_id, thread), partial(render_question, question_id)))
+        replies = fragment('replies:%d:%s' % (question_id, thread), partial(render_replies, question_id))
+        answer = cached_answer(questions['posts'])
+        return render_template('response.html', questions = questions, header = Markup(questions['html']), replies = Markup(replies), answer=answer)
     elif(request.method == 'POST'):
-        file = request.files['imageFile']
-        data = file.read()
-        person = User.query.filter_by(id = current_user.id).first()
+        questions = Post.query.get_or_404(question_id)
+        try:
+            upload = read_upload(request.files.get('imageFile'))
+        except ImageError as e:
+            flash(str(e), "error")
+            return redirect( url_for('response', question_id = questions.id))
         temp = request.form['answer']
-        stuff = Replies(posts = temp, name = person.name, likes = 0, post = questions, data = data)
+        stuff = Replies(posts = temp, name = current_user.name, likes = 0, response = questions.id)
         db.session.add(stuff)
         db.session.commit()
+        fragments.delete('thread:%d' % question_id, 'feed:gen')
+        note_write()
+        queue_image(stuff, upload)
         return redirect( url_for('response', question_id = questions.id))
 
-@app.route('/upvote/<int:reply>/<string:truthfullness>', methods = ['GET'])
-def upvote(reply, truthfullness):
-    truthfullness = str(truthfullness)
-    if not Vote.query.filter_by(user_id = current_user.id, replies_id = reply).first():
-        if truthfullness == 'True':
-            user_id = User.query.filter_by(id = current_user.id).first()
-            post_id = Replies.query.filter_by(id = reply).first()
-            brakeance = Vote(choice = 'True', user_id = user_id.id, replies_id = post_id.id)
-            post_id.likes = post_id.likes + 1
-            db.session.add(brakeance)
+def answer_key(question):
+    return hashlib.sha256(' '.join(question.lower().split()).encode('utf-8')).hexdigest()
+
+def store_answer(key, question):
+    try:
+        answer, ttl = answer_client.fetch(question), app.config['ANSWER_TTL']
+    except Exception:
+        app.logger.warning("Answer lookup failed for %r", question, exc_info = True)
+        answer, ttl = '', app.config['ANSWER_ERROR_TTL']
+    try:
+        with app.app_context():
+            db.session.merge(Answer(key = key, answer = answer, expires = time.time() + ttl))
             db.session.commit()
-            return redirect ( url_for('response', question_id = post_id.response))
-        elif truthfullness == 'False':
-            user_id = User.query.filter_by(id = current_user.id).first()
-            post_id = Replies.query.filter_by(id = reply).first()
-            brakeance = Vote(choice = 'False', user_id = user_id.id, replies_id = post_id.id)
-            post_id.likes = post_id.likes - 1
-            db.session.add(brakeance)
+    finally:
+        with answer_lock:
+            answer_pending.discard(key)
+
+# returns the cached answer, or None when there isn't one yet; misses and
+# expired entries are refreshed in the background so the page never waits
+def cached_answer(question):
+    key = answer_key(question)
+    cached = db.session.get(Answer, key)
+    if cached is not None and cached.expires > time.time():
+        answer_stats.hit()
+        return cached.answer
+    answer_stats.miss(stale = cached is not None)
+    with answer_lock:
+        if key not in answer_pending:
+            answer_pending.add(key)
+            answer_pool.submit(store_answer, key, question)
+    return cached.answer if cached is not None else None
+
+# the page polls this while its lookup is in flight; that lookup was already
+# counted when the page rendered, so only peek and leave answer_stats alone
+def peek_answer(question):
+    cached = db.session.get(Answer, answer_key(question))
+    return cached.answer if cached is not None else None
+
+@app.route('/answer/<int:question_id>', methods = ['GET'])
+@login_required
+@query_budget(3)
+def answer(question_id):
+    questions = Post.query.get_or_404(question_id)
+    found = peek_answer(questions.posts)
+    return jsonify(answer = found, pending = found is None)
+
+@app.route('/answer/stats', methods = ['GET'])
+@login_required
+def answer_metrics():
+    return jsonify(answer_stats.snapshot())
+
+MEDIA_MAX_AGE = 60 * 60 * 24 * 365
+
+# bodies over MAX_CONTENT_LENGTH are refused before read_upload() sees them;
+# tell the user the same way an oversized image is reported
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    flash("Uploads must be smaller than %d MB." % (app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)), "error")
+    return redirect(request.path)
+
+def read_upload(file):
+    data = file.read() if file else b''
+    if data:
+        images.verify(data, app.config['MAX_IMAGE_BYTES'])
+    return data
+
+def store_blob(variant, kind, source):
+    digest = hashlib.sha256(variant.data).hexdigest()
+    if db.session.get(Blob, digest) is None:
+        db.session.add(Blob(sha256 = digest, source = source, kind = kind, mimetype = variant.mimetype,
+                            width = variant.width, height = variant.height, data = variant.data))
+    return digest
+
+def attach_image(model, row_id, source, display, thumb):
+    for attempt in range(2):
+        row = db.session.get(model, row_id)
+        row.image = store_blob(display, 'display', source)
+        row.thumb = store_blob(thumb, 'thumb', source)
+        stale = fragment_keys(row)
+        try:
             db.session.commit()
-            return redirect ( url_for('response', question_id = post_id.response))
-    else:
-        check = Vote.query.filter_by(user_id = current_user.id, replies_id = reply).first()
-        if check.choice == truthfullness:
-            post_id = Replies.query.filter_by(id = reply).first()
-            flash("Sorry, but you've already voted on this", "info")
-            return redirect ( url_for('response', question_id = post_id.response))
-        else:
-            if truthfullness == 'True' and ((check.choice == None) or (check.choice == 'NULL')):
-                print("NANI 1")
-                post_id = Replies.query.filter_by(id = reply).first()
-                post_id.likes = post_id.likes + 1
-                check.choice = 'True'
-                db.session.commit()
-                return redirect ( url_for('response', question_id = post_id.response))
-            elif truthfullness == 'False' and ((check.choice == None) or (check.choice == 'NULL')):
-                print("NANI 2")
-                post_id = Replies.query.filter_by(id = reply).first()
-                post_id.likes = post_id.likes - 1
-                check.choice = 'False'
-                db.session.commit()
-                return redirect ( url_for('response', question_id = post_id.response))
-            if truthfullness == 'False' and check.choice == 'True':
-                post_id = Replies.query.filter_by(id = reply).first()
-                post_id.likes = post_id.likes - 1
-                check.choice = 'NULL'
-                db.session.commit()
-                return redirect ( url_for('response', question_id = post_id.response))
-            elif truthfullness == 'True' and check.choice == 'False':
-                post_id = Replies.query.filter_by(id = reply).first()
-                post_id.likes = post_id.likes + 1
-                check.choice = 'NULL'
-                db.session.commit()
-                return redirect ( url_for('response', question_id = post_id.response))
-
-
-@app.route('/find', methods = ['POST'])
+            fragments.delete(*stale)
+            return
+        except IntegrityError:
+            # an identical upload was stored first, retry and reuse its blobs
+            db.session.rollback()
+    raise RuntimeError("Could not store image for %s %s" % (model.__tablename__, row_id))
+
+def image_done(model, row_id, source, future):
+    try:
+        display, thumb = future.result()
+    except Exception:
+        app.logger.exception("Could not process image for %s %s", model.__tablename__, row_id)
+        return
+    with app.app_context():
+        attach_image(model, row_id, source, display, thumb)
+
+def queue_image(row, data):
+    if not data:
+        return
+    source = hashlib.sha256(data).hexdigest()
+    seen = {blob.kind: blob.sha256 for blob in Blob.query.filter_by(source = source)}
+    if 'display' in seen and 'thumb' in seen:
+        row.image, row.thumb = seen['display'], seen['thumb']
+        stale = fragment_keys(row)
+        db.session.commit()
+        fragments.delete(*stale)
+        return
+    image_pool.submit(images.process, data).add_done_callback(partial(image_done, type(row), row.id, source))
+
+@app.route('/media/<string:digest>', methods = ['GET'])
+@login_required
+@query_budget(2)
+def media(digest):
+    blob = db.session.query(Blob.data, Blob.mimetype).filter(Blob.sha256 == digest).first()
+    if blob is None:
+        abort(404)
+    rv = app.response_class(blob.data, mimetype = blob.mimetype)
+    rv.set_etag(digest)
+    rv.cache_control.private = True
+    rv.cache_control.immutable = True
+    rv.cache_control.max_age = MEDIA_MAX_AGE
+    return rv.make_conditional(request, accept_ranges = True, complete_length = len(blob.data))
+
+# a vote is 'True', 'False' or 'NULL' (withdrawn); clicking the opposite
+# arrow steps one place towards it, clicking the same arrow again does nothing
+def cast_vote(user_id, reply_id, choice):
+    delta = 1 if choice == 'True' else -1
+    opposite = 'False' if choice == 'True' else 'True'
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    db.session.execute(insert(Vote).values(user_id = user_id, replies_id = reply_id, choice = 'NULL')
+                       .on_conflict_do_nothing(index_elements = ['user_id', 'replies_id']))
+    moved = db.session.execute(db.update(Vote)
+                               .where(Vote.user_id == user_id, Vote.replies_id == reply_id, Vote.choice != choice)
+                               .values(choice = db.case((Vote.choice == opposite, 'NULL'), else_ = choice)))
+    if moved.rowcount:
+        db.session.execute(db.update(Replies).where(Replies.id == reply_id)
+                           .values(likes = db.func.coalesce(Replies.likes, 0) + delta))
+    likes = db.session.query(Replies.likes).filter(Replies.id == reply_id).scalar()
+    db.session.commit()
+    return bool(moved.rowcount), likes
+
+@app.route('/upvote/<int:reply>/<string:truthfullness>', methods = ['GET', 'POST'])
+@login_required
+@query_budget(6)
+def upvote(reply, truthfullness):
+    truthfullness = str(truthfullness)
+    if truthfullness not in ('True', 'False'):
+        abort(404)
+    post_id = Replies.query.get_or_404(reply)
+    question_id = post_id.response
+    changed, likes = cast_vote(current_user.id, reply, truthfullness)
+    if changed:
+        fragments.delete('thread:%d' % question_id)
+        note_write()
+    if request.method == 'POST':
+        return jsonify(reply = reply, likes = likes, changed = changed)
+    if not changed:
+        flash("Sorry, but you've already voted on this", "info")
+    return redirect ( url_for('response', question_id = question_id))
+
+
+# post and reply text share one FTS5 index; posts use rowid 2 * id and
+# replies 2 * id + 1 so the triggers can find their row without a scan
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE search_index USING fts5(question, reply, post_id UNINDEXED, tokenize = 'porter unicode61')",
+    "CREATE TRIGGER search_post_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO search_index (rowid, question, post_id) VALUES (new.id * 2, new.posts, new.id); END",
+    "CREATE TRIGGER search_post_update AFTER UPDATE OF posts ON post BEGIN "
+    "UPDATE search_index SET question = new.posts WHERE rowid = new.id * 2; END",
+    "CREATE TRIGGER search_post_delete AFTER DELETE ON post BEGIN "
+    "DELETE FROM search_index WHERE rowid = old.id * 2; END",
+    "CREATE TRIGGER search_reply_insert AFTER INSERT ON replies BEGIN "
+    "INSERT INTO search_index (rowid, reply, post_id) VALUES (new.id * 2 + 1, new.posts, new.response); END",
+    "CREATE TRIGGER search_reply_update AFTER UPDATE OF posts, response ON replies BEGIN "
+    "UPDATE search_index SET reply = new.posts, post_id = new.response WHERE rowid = new.id * 2 + 1; END",
+    "CREATE TRIGGER search_reply_delete AFTER DELETE ON replies BEGIN "
+    "DELETE FROM search_index WHERE rowid = old.id * 2 + 1; END",
+]
+
+# bm25 can't be used inside an aggregate, so score every row that has any of
+# the terms first and then keep the best row per question; the LIMIT -1 stops
+# SQLite from flattening the subquery into the GROUP BY. A question matches
+# when each term turns up somewhere in its thread, not necessarily in one
+# row, so the terms are intersected per post_id. Snippets are only built for
+# the final page
+SEARCH_HITS = (
+    "SELECT post_id, hit, MIN(score) AS best FROM ("
+    "SELECT rowid AS hit, post_id, bm25(search_index, 2.0, 1.0) AS score FROM search_index WHERE search_index MATCH :q LIMIT -1) "
+    "%s GROUP BY post_id ORDER BY best LIMIT :limit OFFSET :offset")
+SEARCH_THREADS = "SELECT post_id FROM search_index WHERE search_index MATCH :term%d"
+MAX_SEARCH_TERMS = 8
+SEARCH_SNIPPETS = db.text(
+    "SELECT rowid, snippet(search_index, -1, char(2), char(3), '...', 16) FROM search_index "
+    "WHERE search_index MATCH :q AND rowid IN :hits").bindparams(db.bindparam('hits', expanding = True))
+
+def rebuild_search_index():
+    db.session.execute(db.text("DELETE FROM search_index"))
+    db.session.execute(db.text("INSERT INTO search_index (rowid, question, post_id) SELECT id * 2, posts, id FROM post"))
+    db.session.execute(db.text("INSERT INTO search_index (rowid, reply, post_id) SELECT id * 2 + 1, posts, response FROM replies"))
+    db.session.execute(db.text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    rebuild_search_index()
+    click.echo("Search index rebuilt.")
+
+def search_terms(text):
+    # quote every word so user input can never be read as FTS5 syntax
+    terms = []
+    for term in re.findall(r'\w+', text.lower()):
+        if '"%s"' % term not in terms:
+            terms.append('"%s"' % term)
+    return terms[:MAX_SEARCH_TERMS]
+
+def search_hits(terms):
+    threads = ''
+    if len(terms) > 1:
+        threads = 'WHERE post_id IN (%s)' % ' INTERSECT '.join(SEARCH_THREADS % i for i in range(len(terms)))
+    return db.text(SEARCH_HITS % threads)
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_posts(text, page, limit):
+    terms = search_terms(text)
+    if not terms:
+        return [], {}, False
+    if db.engine.dialect.name != 'sqlite':
+        return search_posts_like(text, page, limit)
+    query = ' OR '.join(terms)
+    params = {'term%d' % i: term for i, term in enumerate(terms)}
+    params.update(q = query, limit = limit + 1, offset = (page - 1) * limit)
+    hits = db.session.execute(search_hits(terms), params).all()
+    more = len(hits) > limit
+    hits = hits[:limit]
+    if not hits:
+        return [], {}, more
+    snippets = dict(db.session.execute(SEARCH_SNIPPETS, {'q': query, 'hits': [hit.hit for hit in hits]}).all())
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_([hit.post_id for hit in hits]))}
+    preguntas = [posts[hit.post_id] for hit in hits if hit.post_id in posts]
+    return preguntas, {hit.post_id: highlight(snippets.get(hit.hit, '')) for hit in hits}, more
+
+# FTS5 only exists on SQLite; other databases fall back to matching every
+# word against the question text or any of its replies
+def search_posts_like(text, page, limit):
+    scope = Post.query
+    for term in re.findall(r'\w+', text):
+        pattern = '%' + term + '%'
+        scope = scope.filter(db.or_(Post.posts.ilike(pattern), Post.reply.any(Replies.posts.ilike(pattern))))
+    preguntas = scope.order_by(Post.id.desc()).limit(limit + 1).offset((page - 1) * limit).all()
+    return preguntas[:limit], {}, len(preguntas) > limit
+
+@app.route('/find', methods = ['GET', 'POST'])
 @login_required
+@query_budget(4)
 def find():
-    temp = request.form['filtered']
-    scope = Post.query.filter(Post.posts.contains(temp))
-    return render_template('find.html', preguntas = scope, result=temp)
+    temp = request.values.get('filtered', '')
+    page = max(request.args.get('page', 1, type = int), 1)
+    scope, snippets, more = search_posts(temp, page, app.config['SEARCH_PAGE_SIZE'])
+    return render_template('find.html', preguntas = scope, snippets = snippets, result=temp, page = page, more = more)
 
 @app.route("/")
 def home():
@@ -242,8 +743,160 @@ def game():
     return render_template('game.html')
 
 
+# the tables as each migration first creates them, frozen here instead of
+# read off the models so a migration does the same thing on every database,
+# however far the models have moved on since it shipped
+baseline = db.MetaData()
+
+db.Table('user', baseline,
+    db.Column('id', db.Integer, primary_key = True),
+    db.Column('name', db.String, unique = True, nullable = False),
+    db.Column('username', db.String, unique = True, nullable = False),
+    db.Column('password', db.String, nullable = False))
+
+db.Table('post', baseline,
+    db.Column('id', db.Integer, primary_key = True),
+    db.Column('name', db.String),
+    db.Column('posts', db.Text),
+    db.Column('data', db.LargeBinary, nullable = False))
+
+db.Table('replies', baseline,
+    db.Column('id', db.Integer, primary_key = True),
+    db.Column('posts', db.Text),
+    db.Column('name', db.String),
+    db.Column('likes', db.Integer),
+    db.Column('data', db.LargeBinary, nullable = False),
+    db.Column('response', db.Integer, db.ForeignKey('post.id')))
+
+db.Table('vote', baseline,
+    db.Column('id', db.Integer, primary_key = True),
+    db.Column('choice', db.String, nullable = False),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column('replies_id', db.Integer, db.ForeignKey('replies.id')))
+
+db.Table('blob', baseline,
+    db.Column('sha256', db.String(64), primary_key = True),
+    db.Column('source', db.String(64), index = True),
+    db.Column('kind', db.String, nullable = False),
+    db.Column('mimetype', db.String, nullable = False),
+    db.Column('width', db.Integer),
+    db.Column('height', db.Integer),
+    db.Column('data', db.LargeBinary, nullable = False))
+
+db.Table('answer', baseline,
+    db.Column('key', db.String(64), primary_key = True),
+    db.Column('answer', db.Text, nullable = False),
+    db.Column('expires', db.Float, nullable = False))
+
+def create_tables(*names):
+    baseline.create_all(db.session.connection(), tables = [baseline.tables[name] for name in names])
+
+def create_index(name, table, *columns, unique = False):
+    table = baseline.tables[table]
+    db.Index(name, *[table.c[column] for column in columns], unique = unique).create(db.session.connection(), checkfirst = True)
+
+def add_image_columns():
+    create_tables('blob')
+    inspector = db.inspect(db.session.connection())
+    for table in ('post', 'replies'):
+        columns = {column['name'] for column in inspector.get_columns(table)}
+        for name in ('image', 'thumb'):
+            if name not in columns:
+                db.session.execute(db.text('ALTER TABLE %s ADD COLUMN %s VARCHAR(64) REFERENCES blob (sha256)' % (table, name)))
+
+def move_legacy_images():
+    # images uploaded before the pipeline existed still live inline in data
+    blob = baseline.tables['blob']
+    for name in ('post', 'replies'):
+        table = db.table(name, db.column('id'), db.column('data'), db.column('image'), db.column('thumb'))
+        legacy = db.select(table.c.id, table.c.data).where(table.c.image == None, db.func.length(table.c.data) > 0)
+        for row_id, data in db.session.execute(legacy).all():
+            try:
+                images.verify(data, len(data))
+                variants = images.process(data)
+            except (ImageError, OSError):
+                continue
+            digests = []
+            for kind, variant in zip(('display', 'thumb'), variants):
+                digest = hashlib.sha256(variant.data).hexdigest()
+                if db.session.execute(db.select(blob.c.sha256).where(blob.c.sha256 == digest)).first() is None:
+                    db.session.execute(blob.insert().values(sha256 = digest, source = hashlib.sha256(data).hexdigest(), kind = kind,
+                                                            mimetype = variant.mimetype, width = variant.width, height = variant.height, data = variant.data))
+                digests.append(digest)
+            db.session.execute(table.update().where(table.c.id == row_id).values(image = digests[0], thumb = digests[1], data = b''))
+            db.session.commit()
+
+def unique_votes():
+    # older databases could hold several votes per user and reply; keep the
+    # latest one so the unique index can be built, then recount every score
+    # the duplicates had inflated
+    db.session.execute(db.text("DELETE FROM vote WHERE id NOT IN (SELECT MAX(id) FROM vote GROUP BY user_id, replies_id)"))
+    db.session.execute(db.text(
+        "UPDATE replies SET likes = (SELECT COALESCE(SUM(CASE choice WHEN 'True' THEN 1 WHEN 'False' THEN -1 ELSE 0 END), 0) "
+        "FROM vote WHERE replies_id = replies.id)"))
+    create_index('ix_vote_user_reply', 'vote', 'user_id', 'replies_id', unique = True)
+    create_index('ix_vote_replies_id', 'vote', 'replies_id')
+
+def create_search_index():
+    if db.engine.dialect.name != 'sqlite' or db.inspect(db.session.connection()).has_table('search_index'):
+        return
+    for statement in SEARCH_SCHEMA:
+        db.session.execute(db.text(statement))
+    rebuild_search_index()
+
+# applied in order and recorded in schema_migrations; never edit or reorder
+# an entry once it has shipped, append a new one instead. Migrations only
+# touch the frozen tables above or plain SQL, never the models
+MIGRATIONS = [
+    (1, 'create tables', lambda: create_tables('user', 'post', 'replies', 'vote')),
+    (2, 'image columns', add_image_columns),
+    (3, 'legacy images to blobs', move_legacy_images),
+    (4, 'index replies.response', lambda: create_index('ix_replies_response', 'replies', 'response')),
+    (5, 'search index', create_search_index),
+    (6, 'unique votes and vote indexes', unique_votes),
+    (7, 'answer cache', lambda: create_tables('answer')),
+]
+
+def upgrade_schema():
+    db.session.execute(db.text("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name VARCHAR NOT NULL)"))
+    db.session.commit()
+    done = {version for (version,) in db.session.execute(db.text("SELECT version FROM schema_migrations"))}
+    for version, name, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        migrate()
+        db.session.execute(db.text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"), {'version': version, 'name': name})
+        db.session.commit()
+        click.echo("Applied migration %d: %s" % (version, name))
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    upgrade_schema()
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+def pending_migrations():
+    if not db.inspect(db.engine).has_table('schema_migrations'):
+        return [version for version, name, migrate in MIGRATIONS]
+    done = {version for (version,) in db.session.execute(db.text("SELECT version FROM schema_migrations"))}
+    return [version for version, name, migrate in MIGRATIONS if version not in done]
+
+def require_current_schema():
+    pending = pending_migrations()
+    db.session.remove()
+    db.engine.dispose()
+    if pending:
+        raise SchemaOutOfDate("The database is missing migrations %s. Run `flask --app app upgrade-db` before starting the server."
+                              % ', '.join(str(version) for version in pending))
+
+# python app.py upgrades the schema itself and the flask command has to load
+# the app to run upgrade-db; anything else that imports the app to serve it
+# refuses to start on an old schema instead of failing on every page
 if __name__ == '__main__':
+    with app.app_context():
+        upgrade_schema()
     app.run(debug=True)
-
-with app.app_context():
-    db.create_all()
\ No newline at end of file
+elif app.config['REQUIRE_CURRENT_SCHEMA'] and os.environ.get('FLASK_RUN_FROM_CLI') != 'true':
+    with app.app_context():
+        require_current_schema()
@@ -0,0 +1,62 @@
+"""Cost controls for the login path: a bounded pool for password hashing,
+token-bucket rate limits and the cached session user.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from flask_login import UserMixin
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class HashPool:
+    # caps how many password hashes a worker process runs at once. The hash
+    # runs on the request's own thread (bcrypt releases the GIL), so with a
+    # threaded worker the other threads keep serving pages; past the cap a
+    # request waits only while there is queue room and is refused otherwise
+    def __init__(self, workers, queue = 0):
+        self.running = threading.BoundedSemaphore(workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking = False):
+            raise HasherBusy()
+        try:
+            with self.running:
+                return fn(*args)
+        finally:
+            self.slots.release()
+
+
+class RateLimiter:
+    def __init__(self, burst, per_second, max_keys = 100000):
+        self.burst = burst
+        self.per_second = per_second
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # takes one token for key; returns 0 when allowed, otherwise the number
+    # of seconds until a token will be available
+    def take(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.per_second)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.per_second
+            if not wait:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last = False)
+            return wait
+
+
+class SessionUser(UserMixin):
+    def __init__(self, id, name, username):
+        self.id = id
+        self.name = name
+        self.username = username
@@ -0,0 +1,120 @@
+"""Shared setup for the benchmark scripts: a scratch database, seeding
+helpers, timing helpers and a gunicorn server for the load tests.
+
+app.py reads its configuration when it is imported, so every script calls
+scratch_database() with any other settings it needs before load_app().
+"""
+import contextlib
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-pass'
+
+sys.path.insert(0, ROOT)
+
+
+def scratch_database(**env):
+    path = os.path.join(tempfile.mkdtemp(prefix = 'forum-bench-'), 'bench.sqlite')
+    # nothing here should wait on the real answer API; a closed port fails fast.
+    # load_app() creates the schema after the import, so the import-time check
+    # is off here and back on for the servers
+    os.environ.update({'DATABASE_URL': 'sqlite:///' + path, 'ANSWER_API_URL': 'http://127.0.0.1:9/', 'BCRYPT_LOG_ROUNDS': '4',
+                       'REQUIRE_CURRENT_SCHEMA': '0'})
+    os.environ.update(env)
+    return path
+
+
+def load_app():
+    import app as forum
+    forum.app.config['WTF_CSRF_ENABLED'] = False
+    forum.app.logger.setLevel(logging.ERROR)
+    with forum.app.app_context():
+        forum.upgrade_schema()
+    return forum
+
+
+def insert(forum, model, rows, batch = 5000):
+    with forum.app.app_context():
+        for start in range(0, len(rows), batch):
+            forum.db.session.execute(model.__table__.insert(), rows[start:start + batch])
+            forum.db.session.commit()
+
+
+def seed_users(forum, count):
+    hashed = forum.bcrypt.generate_password_hash(PASSWORD + forum.salt).decode('utf-8')
+    insert(forum, forum.User, [{'name': 'bench%d' % i, 'username': 'bench%d' % i, 'password': hashed} for i in range(count)])
+
+
+def seed_posts(forum, count, replies_every = 3, **columns):
+    with forum.app.app_context():
+        first = (forum.db.session.query(forum.db.func.max(forum.Post.id)).scalar() or 0) + 1
+    ids = range(first, first + count)
+    insert(forum, forum.Post, [dict({'data': b''}, id = i, name = 'bench0', posts = 'how do I beat the dragons %d' % i, **columns) for i in ids])
+    insert(forum, forum.Replies, [{'name': 'bench1', 'posts': 'bring fire resistance %d' % i, 'likes': 0, 'data': b'', 'response': i}
+                                  for i in ids if replies_every and i % replies_every == 0])
+    return ids
+
+
+def logged_in_client(forum, user_id = 1):
+    client = forum.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['auth_token'] = 'bench'
+    return client
+
+
+def timed(fn, times):
+    samples = []
+    for i in range(times):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summary(samples):
+    return 'p50 %.1fms p95 %.1fms p99 %.1fms' % tuple(percentile(samples, fraction) * 1000 for fraction in (.5, .95, .99))
+
+
+@contextlib.contextmanager
+def serve(workers, port = 8150, threads = 0, **env):
+    pidfile = os.path.join(tempfile.mkdtemp(prefix = 'forum-bench-'), 'gunicorn.pid')
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', '127.0.0.1:%d' % port,
+               '--pythonpath', '%s,%s' % (ROOT, BENCH), '--pid', pidfile, 'server:app']
+    if threads:
+        command += ['--worker-class', 'gthread', '--threads', str(threads)]
+    process = subprocess.Popen(command, env = dict(os.environ, REQUIRE_CURRENT_SCHEMA = '1', **env), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    base = 'http://127.0.0.1:%d' % port
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(base + '/about', timeout = 5)
+                break
+            except requests.RequestException:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('gunicorn did not start: %s' % ' '.join(command))
+                time.sleep(0.2)
+        yield base
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+def bench_session(base, user_id):
+    session = requests.Session()
+    session.post(base + '/bench-login/%d' % user_id).raise_for_status()
+    return session
@@ -0,0 +1,90 @@
+"""Dashboard size and latency with every post carrying an image, before and
+after images moved out of the page, and what a /media fetch costs before and
+after the browser has cached it.
+
+    python bench/dashboard_images.py [--posts 1000] [--image 200x150] [--limit 20]
+                                     [--requests 50] [--cache none|memory]
+
+"before" is the original dashboard: every post loaded with its upload and
+inlined as base64 into the original template, which is read from the
+baseline commit with git. "after" is the paged feed that links thumbnails
+from /media. Both run over the same seeded posts and uploads.
+
+--cache none (the default) renders every page, which is what a cold cache or
+a fresh worker pays.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import random
+import subprocess
+
+from common import ROOT, load_app, logged_in_client, scratch_database, seed_posts, seed_users, summary, timed
+
+BASELINE = 'ee10a4b'
+
+
+def sample_image(width, height):
+    from PIL import Image
+    # noise keeps the encoder honest; a flat colour would compress to nothing
+    img = Image.frombytes('RGB', (width, height), random.Random(1).randbytes(width * height * 3))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality = 90)
+    return out.getvalue()
+
+
+def add_baseline_view(forum):
+    from flask import render_template_string
+    template = subprocess.run(['git', 'show', '%s:templates/dashboard.html' % BASELINE], cwd = ROOT,
+                              capture_output = True, text = True, check = True).stdout
+
+    @forum.app.route('/bench-baseline-dashboard')
+    @forum.login_required
+    def baseline_dashboard():
+        preguntas = forum.Post.query.options(forum.db.undefer(forum.Post.data)).all()
+        images = [base64.b64encode(post.data).decode('utf-8') for post in preguntas]
+        return render_template_string(template, preguntas = preguntas, images = images)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type = int, default = 1000)
+    parser.add_argument('--image', default = '200x150', help = 'size of the seeded uploads')
+    parser.add_argument('--limit', type = int, default = 20, help = 'posts per dashboard page')
+    parser.add_argument('--requests', type = int, default = 50)
+    parser.add_argument('--cache', default = 'none')
+    args = parser.parse_args()
+
+    scratch_database(FRAGMENT_CACHE = args.cache)
+    forum = load_app()
+    add_baseline_view(forum)
+    import images
+    upload = sample_image(*[int(side) for side in args.image.split('x')])
+    display, thumb = images.process(upload)
+    with forum.app.app_context():
+        digests = [forum.store_blob(variant, kind, hashlib.sha256(upload).hexdigest())
+                   for variant, kind in ((display, 'display'), (thumb, 'thumb'))]
+        forum.db.session.commit()
+    seed_users(forum, 2)
+    # the upload stays inline in data too, which is where the old page read it
+    seed_posts(forum, args.posts, image = digests[0], thumb = digests[1], data = upload)
+
+    client = logged_in_client(forum)
+    print('%d posts with a %.1f KB upload each' % (args.posts, len(upload) / 1024))
+    for label, url in (('before: inline base64, every post', '/bench-baseline-dashboard'),
+                       ('after: /media thumbnails, %d per page' % args.limit, '/dashboard?limit=%d' % args.limit)):
+        page = client.get(url)
+        assert page.status_code == 200, page.status_code
+        print('%-40s %12d bytes  %s' % (label, len(page.data), summary(timed(lambda: client.get(url), args.requests))))
+
+    media = client.get('/media/%s' % digests[1])
+    print('thumbnail: %d %s, %d bytes, Cache-Control: %s' % (media.status_code, media.mimetype, len(media.data), media.headers['Cache-Control']))
+    again = client.get('/media/%s' % digests[1], headers = {'If-None-Match': media.headers['ETag']})
+    print('revalidated thumbnail: %d, %d bytes' % (again.status_code, len(again.data)))
+    part = client.get('/media/%s' % digests[0], headers = {'Range': 'bytes=0-1023'})
+    print('ranged display image: %d, %d bytes' % (part.status_code, len(part.data)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Feed latency as the forum grows: the first page, a page halfway down and
+the JSON feed, measured at each size with the fragment cache off.
+
+    python bench/feed_depth.py [--sizes 1000,10000,100000] [--requests 200]
+
+Keyset paging should keep every column flat as the post count grows.
+"""
+import argparse
+
+from common import load_app, logged_in_client, scratch_database, seed_posts, seed_users, summary, timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default = '1000,10000,100000')
+    parser.add_argument('--requests', type = int, default = 200)
+    args = parser.parse_args()
+
+    scratch_database(FRAGMENT_CACHE = 'none')
+    forum = load_app()
+    seed_users(forum, 2)
+    client = logged_in_client(forum)
+    total = 0
+    for size in [int(size) for size in args.sizes.split(',')]:
+        seed_posts(forum, size - total)
+        total = size
+        for label, url in (('first page', '/dashboard'),
+                           ('halfway', '/dashboard?before=%d' % (total // 2)),
+                           ('json', '/dashboard?format=json&before=%d' % (total // 3))):
+            assert client.get(url).status_code == 200
+            print('%7d posts  %-10s  %s' % (total, label, summary(timed(lambda: client.get(url), args.requests))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Requests per second on one busy question page, with and without the
+fragment cache, plus the queries each view runs.
+
+    python bench/hot_thread.py [--replies 50] [--seconds 10] [--caches none,memory]
+
+Each cache backend runs in its own process, because app.py picks the
+backend when it is imported. A redis:// URL works as a backend too.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from common import load_app, logged_in_client, scratch_database, seed_posts, seed_users
+
+
+def measure(question, seconds):
+    forum = load_app()
+    client = logged_in_client(forum)
+    url = '/response/%d' % question
+    queries = client.get(url).headers['X-Query-Count'], client.get(url).headers['X-Query-Count']
+    views, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        client.get(url)
+        views += 1
+    print('%-8s %6.0f req/s  queries per view: %s cold, %s warm' % (
+        os.environ['FRAGMENT_CACHE'], views / (time.perf_counter() - started), queries[0], queries[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replies', type = int, default = 50)
+    parser.add_argument('--seconds', type = float, default = 10)
+    parser.add_argument('--caches', default = 'none,memory')
+    parser.add_argument('--measure', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        return measure(args.measure, args.seconds)
+
+    scratch_database(PROFILE_REQUESTS = '1')
+    forum = load_app()
+    seed_users(forum, 2)
+    (question,) = seed_posts(forum, 1, replies_every = 0)
+    with forum.app.app_context():
+        forum.db.session.add_all([forum.Replies(name = 'bench1', posts = 'hot reply %d' % i, likes = i, response = question)
+                                  for i in range(args.replies)])
+        forum.db.session.commit()
+    print('one question with %d replies, %.0f s per backend' % (args.replies, args.seconds))
+    for backend in args.caches.split(','):
+        subprocess.run([sys.executable, __file__, '--measure', str(question), '--seconds', str(args.seconds)],
+                       env = dict(os.environ, FRAGMENT_CACHE = backend), check = True)
+
+
+if __name__ == '__main__':
+    main()
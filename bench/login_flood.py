@@ -0,0 +1,77 @@
+"""Browsing latency for signed-in users while someone floods /login with
+wrong passwords, at a few flood rates.
+
+    python bench/login_flood.py [--rates 0,50,200] [--seconds 10] [--workers 2] [--threads 8] [--unlimited]
+
+Each rate gets a fresh server so no rate-limit state carries over.
+--threads 0 runs gunicorn's sync workers instead of gthread ones.
+--unlimited lifts the login rate limits, leaving only the bounded hash pool.
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+from common import PASSWORD, bench_session, load_app, scratch_database, seed_posts, seed_users, serve, summary
+
+ATTACKERS = 24
+BROWSERS = 4
+
+
+def run(base, rate, seconds, question):
+    samples, statuses, lock = [], {}, threading.Lock()
+    stop = time.time() + seconds
+
+    def browse(user_id):
+        session = bench_session(base, user_id)
+        while time.time() < stop:
+            for url in ('/dashboard', '/response/%d' % question):
+                started = time.perf_counter()
+                rv = session.get(base + url)
+                samples.append(time.perf_counter() - started)
+                assert rv.status_code == 200, rv.status_code
+
+    def attack():
+        session, gap, due = requests.Session(), ATTACKERS / float(rate), time.time()
+        while time.time() < stop:
+            due += gap
+            time.sleep(max(0, due - time.time()))
+            try:
+                rv = session.post(base + '/login', data = {'username': 'bench0', 'password': 'not-' + PASSWORD}, allow_redirects = False)
+                status = rv.status_code
+            except requests.ConnectionError:
+                # gthread drops idle keep-alive connections; keep attacking
+                status = 'dropped'
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target = browse, args = (i + 2,)) for i in range(BROWSERS)]
+    threads += [threading.Thread(target = attack) for i in range(ATTACKERS if rate else 0)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('flood %4d/s: browsing %5d requests, %s; login responses %s' % (rate, len(samples), summary(samples), statuses))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rates', default = '0,50,200')
+    parser.add_argument('--seconds', type = float, default = 10)
+    parser.add_argument('--workers', type = int, default = 2)
+    parser.add_argument('--threads', type = int, default = 8)
+    parser.add_argument('--unlimited', action = 'store_true')
+    args = parser.parse_args()
+
+    scratch_database(BCRYPT_LOG_ROUNDS = '12')
+    forum = load_app()
+    seed_users(forum, BROWSERS + 2)
+    question = seed_posts(forum, 100)[-1]
+    for rate in [int(rate) for rate in args.rates.split(',')]:
+        with serve(args.workers, threads = args.threads, BENCH_UNLIMITED = '1' if args.unlimited else '0') as base:
+            run(base, rate, args.seconds, question)
+
+
+if __name__ == '__main__':
+    main()
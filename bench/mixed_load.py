@@ -0,0 +1,72 @@
+"""Mixed read/write traffic against gunicorn with several workers sharing
+one SQLite file. Reports throughput, latency and every error status, so a
+'database is locked' shows up as a 500.
+
+    python bench/mixed_load.py [--workers 4] [--clients 16] [--seconds 20]
+                               [--writes 0.2] [--journal WAL|DELETE]
+
+--writes is the share of requests that write: three in four of those are
+votes and the rest are new questions. The reads are 7 feed pages to 1 search.
+--journal DELETE runs the same load on SQLite's default rollback journal
+for comparison.
+"""
+import argparse
+import random
+import threading
+import time
+
+from common import bench_session, load_app, scratch_database, seed_posts, seed_users, serve, summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--clients', type = int, default = 16)
+    parser.add_argument('--seconds', type = float, default = 20)
+    parser.add_argument('--writes', type = float, default = 0.2)
+    parser.add_argument('--journal', default = 'WAL')
+    args = parser.parse_args()
+
+    scratch_database(SQLITE_JOURNAL_MODE = args.journal)
+    forum = load_app()
+    seed_users(forum, 40)
+    posts = seed_posts(forum, 5000, replies_every = 2)
+    with forum.app.app_context():
+        replies = [reply_id for (reply_id,) in forum.db.session.query(forum.Replies.id)]
+        forum.db.engine.dispose()
+
+    samples, statuses, lock = [], {}, threading.Lock()
+
+    def client(base, user_id, stop):
+        session = bench_session(base, user_id)
+        while time.time() < stop:
+            roll = random.random()
+            started = time.perf_counter()
+            if roll < args.writes * 0.75:
+                rv = session.post(base + '/upvote/%d/%s' % (random.choice(replies), random.choice(['True', 'False'])))
+            elif roll < args.writes:
+                rv = session.post(base + '/dashboard', data = {'askquestion': 'a new question'}, allow_redirects = False)
+            elif roll < args.writes + (1 - args.writes) * 7 / 8:
+                rv = session.get(base + '/dashboard?before=%d' % random.choice(posts))
+            else:
+                rv = session.get(base + '/find?filtered=dragons+%d' % random.choice(posts))
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.append(elapsed)
+                statuses[rv.status_code] = statuses.get(rv.status_code, 0) + 1
+
+    with serve(args.workers) as base:
+        stop = time.time() + args.seconds
+        threads = [threading.Thread(target = client, args = (base, 1 + i % 40, stop)) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    print('%s journal, %d workers, %d clients, %d%% writes: %.0f req/s, %s, %d errors %s' % (
+        args.journal, args.workers, args.clients, args.writes * 100, len(samples) / args.seconds, summary(samples), errors, statuses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""The forum as the load scripts serve it: CSRF off, and a /bench-login/<id>
+route so many clients from one address can sign in without tripping the
+login rate limits. BENCH_UNLIMITED=1 lifts those limits for /login as well,
+to show what they buy. Only ever started by common.serve().
+"""
+import os
+import uuid
+
+from flask import session
+from flask_login import login_user
+
+import app as forum
+
+app = forum.app
+app.config['WTF_CSRF_ENABLED'] = False
+
+if os.environ.get('BENCH_UNLIMITED') == '1':
+    forum.login_ip_limit.burst = forum.login_user_limit.burst = 10 ** 9
+
+
+@app.route('/bench-login/<int:user_id>', methods = ['POST'])
+def bench_login(user_id):
+    login_user(forum.db.session.get(forum.User, user_id))
+    session['auth_token'] = uuid.uuid4().hex
+    return 'ok'
@@ -0,0 +1,91 @@
+"""Size-bounded caches for rendered page fragments.
+
+Values are strings. LRUCache lives inside one process, so an invalidation
+only reaches the worker that made it and the others serve their copy until
+it expires; with several workers use RedisCache so it reaches all of them.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+class LRUCache:
+    def __init__(self, max_bytes, max_items, ttl):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.ttl = ttl
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        cost = len(key) + len(value)
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.size += cost
+            while self.size > self.max_bytes or len(self.items) > self.max_items:
+                self._remove(next(iter(self.items)))
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self._remove(key)
+
+    def _remove(self, key):
+        value, expires = self.items.pop(key)
+        self.size -= len(key) + len(value)
+
+
+class RedisCache:
+    def __init__(self, url, ttl, prefix = 'forum:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value.encode('utf-8'), ex = self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+def make_cache(backend, max_bytes, max_items, ttl):
+    if backend == 'none':
+        return NullCache()
+    if backend == 'memory':
+        return LRUCache(max_bytes, max_items, ttl)
+    return RedisCache(backend, ttl)
@@ -0,0 +1,56 @@
+"""Validation and resizing of uploaded images.
+
+Nothing in here touches Flask or the database so the heavy functions can be
+handed to a process pool.
+"""
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP'}
+DISPLAY_SIZE = (1280, 1280)
+THUMB_SIZE = (400, 200)
+JPEG_QUALITY = 85
+
+# refuse anything that would decode to more than ~40 megapixels
+Image.MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+
+Variant = namedtuple('Variant', ['data', 'mimetype', 'width', 'height'])
+
+
+class ImageError(ValueError):
+    pass
+
+
+def verify(data, max_bytes):
+    if len(data) > max_bytes:
+        raise ImageError("Images must be smaller than %d MB." % (max_bytes // (1024 * 1024)))
+    try:
+        with Image.open(BytesIO(data)) as img:
+            fmt = img.format
+            img.verify()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise ImageError("That file is not a valid image.")
+    if fmt not in ALLOWED_FORMATS:
+        raise ImageError("Only PNG, JPEG, GIF and WebP images are supported.")
+    return fmt
+
+
+def process(data):
+    with Image.open(BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        return encode(img, DISPLAY_SIZE), encode(img, THUMB_SIZE)
+
+
+def encode(img, size):
+    img = img.copy()
+    img.thumbnail(size, Image.LANCZOS)
+    out = BytesIO()
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img.save(out, 'PNG', optimize = True)
+        mimetype = 'image/png'
+    else:
+        img.convert('RGB').save(out, 'JPEG', quality = JPEG_QUALITY, optimize = True, progressive = True)
+        mimetype = 'image/jpeg'
+    return Variant(out.getvalue(), mimetype, img.width, img.height)
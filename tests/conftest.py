@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a throwaway
+# database before anything imports it; the schema fixture creates the tables
+# after the import, so the import-time schema check is off
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+os.environ['ANSWER_API_URL'] = 'http://127.0.0.1:9/'
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['REQUIRE_CURRENT_SCHEMA'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as forum_app
+from answers import AnswerStats
+from cache import make_cache
+
+
+@pytest.fixture(scope = 'session')
+def schema():
+    with forum_app.app.app_context():
+        forum_app.upgrade_schema()
+
+
+@pytest.fixture
+def forum(schema):
+    forum_app.app.config.update(TESTING = True, WTF_CSRF_ENABLED = False)
+    reset_state()
+    yield forum_app
+    with forum_app.app.app_context():
+        for table in ('vote', 'replies', 'post', 'user', 'answer', 'blob'):
+            forum_app.db.session.execute(forum_app.db.text('DELETE FROM "%s"' % table))
+        forum_app.db.session.commit()
+
+
+# SQLite hands deleted ids out again, so nothing cached about one test's rows
+# may survive into the next
+def reset_state():
+    config = forum_app.app.config
+    forum_app.fragments = make_cache('memory', config['FRAGMENT_CACHE_BYTES'], config['FRAGMENT_CACHE_ITEMS'], config['FRAGMENT_TTL'])
+    forum_app.session_users = make_cache('memory', 4 * 1024 * 1024, 10000, config['SESSION_USER_TTL'])
+    forum_app.login_ip_limit.buckets.clear()
+    forum_app.login_user_limit.buckets.clear()
+    forum_app.answer_stats = forum_app.answer_client.stats = AnswerStats()
+    forum_app.answer_pending.clear()
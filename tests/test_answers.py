@@ -0,0 +1,128 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+import time
+
+import pytest
+
+
+class StubAnswers(BaseHTTPRequestHandler):
+    # answers every question with its own text; questions mentioning 'slow'
+    # hang for longer than the client is willing to wait
+    def do_GET(self):
+        question = parse_qs(urlparse(self.path).query)['q'][0]
+        self.server.questions.append(question)
+        if 'slow' in question:
+            time.sleep(3)
+        time.sleep(self.server.delay)
+        body = json.dumps({'Abstract': 'About: ' + question}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(forum):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubAnswers)
+    server.daemon_threads = True
+    server.questions, server.delay = [], 0.2
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url, timeout = forum.answer_client.url, forum.answer_client.timeout
+    forum.app.config['ANSWER_API_URL'] = forum.answer_client.url = 'http://127.0.0.1:%d/' % server.server_port
+    forum.answer_client.timeout = 0.5
+    yield server
+    forum.app.config['ANSWER_API_URL'] = forum.answer_client.url = url
+    forum.answer_client.timeout = timeout
+    server.shutdown()
+    server.server_close()
+
+
+def viewer(forum, question):
+    with forum.app.app_context():
+        user = forum.User(name = 'reader', username = 'reader', password = 'x')
+        post = forum.Post(name = 'reader', posts = question)
+        forum.db.session.add_all([user, post])
+        forum.db.session.commit()
+        user_id, post_id = user.id, post.id
+    client = forum.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    return client, post_id
+
+
+def settled(forum, timeout = 10):
+    deadline = time.time() + timeout
+    while forum.answer_pending and time.time() < deadline:
+        time.sleep(0.02)
+    assert not forum.answer_pending
+
+
+def test_first_view_renders_without_waiting_and_queues_one_fetch(forum, stub):
+    stub.delay = 2
+    client, post_id = viewer(forum, 'what is a tarnished')
+    started = time.perf_counter()
+    pages = [client.get('/response/%d' % post_id) for i in range(3)]
+    assert time.perf_counter() - started < stub.delay
+    for page in pages:
+        assert page.status_code == 200
+        assert b'Looking that up...' in page.data
+    settled(forum)
+    assert stub.questions == ['what is a tarnished']
+
+
+def test_poll_returns_the_answer_once_the_fetch_lands(forum, stub):
+    client, post_id = viewer(forum, 'what is a tarnished')
+    client.get('/response/%d' % post_id)
+    assert client.get('/answer/%d' % post_id).json == {'answer': None, 'pending': True}
+    settled(forum)
+    assert client.get('/answer/%d' % post_id).json == {'answer': 'About: what is a tarnished', 'pending': False}
+    assert b'About: what is a tarnished' in client.get('/response/%d' % post_id).data
+    assert stub.questions == ['what is a tarnished']
+
+
+def test_slow_upstream_is_cut_off_at_the_timeout(forum, stub):
+    client, post_id = viewer(forum, 'a slow question')
+    client.get('/response/%d' % post_id)
+    started = time.perf_counter()
+    settled(forum)
+    assert time.perf_counter() - started < 2
+    stats = client.get('/answer/stats').json
+    assert stats['failures'] == 1
+    assert stats['upstream_max_ms'] < 2000
+    # the failure is cached briefly as "no answer" so the page stops polling
+    assert client.get('/answer/%d' % post_id).json == {'answer': '', 'pending': False}
+
+
+def test_stats_count_page_views_not_polls(forum, stub):
+    client, post_id = viewer(forum, 'what is a tarnished')
+    client.get('/response/%d' % post_id)
+    for i in range(5):
+        client.get('/answer/%d' % post_id)
+    settled(forum)
+    client.get('/answer/%d' % post_id)
+    client.get('/response/%d' % post_id)
+    client.get('/response/%d' % post_id)
+    stats = client.get('/answer/stats').json
+    assert (stats['hits'], stats['misses'], stats['stale']) == (2, 1, 0)
+    assert stats['hit_rate'] == pytest.approx(2 / 3)
+    assert (stats['fetches'], stats['failures']) == (1, 0)
+
+
+def test_expired_answer_is_served_stale_and_refreshed(forum, stub):
+    client, post_id = viewer(forum, 'what is a tarnished')
+    client.get('/response/%d' % post_id)
+    settled(forum)
+    with forum.app.app_context():
+        forum.db.session.execute(forum.db.update(forum.Answer).values(answer = 'old answer', expires = 0))
+        forum.db.session.commit()
+    assert b'old answer' in client.get('/response/%d' % post_id).data
+    settled(forum)
+    assert client.get('/answer/%d' % post_id).json['answer'] == 'About: what is a tarnished'
+    stats = client.get('/answer/stats').json
+    assert (stats['misses'], stats['stale'], stats['fetches']) == (2, 1, 2)
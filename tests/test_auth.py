@@ -0,0 +1,144 @@
+import threading
+
+import pytest
+
+import auth
+from auth import HashPool, HasherBusy, RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth.time, 'monotonic', clock)
+    return clock
+
+
+def test_rate_limiter_spends_the_burst_then_says_how_long_to_wait(clock):
+    limiter = RateLimiter(2, 0.5)
+    assert [limiter.take('a'), limiter.take('a')] == [0, 0]
+    assert limiter.take('a') == pytest.approx(2.0)
+    assert limiter.take('b') == 0
+    clock.now += 1
+    assert limiter.take('a') == pytest.approx(1.0)
+    clock.now += 1
+    assert limiter.take('a') == 0
+    assert limiter.take('a') == pytest.approx(2.0)
+
+
+def test_rate_limiter_refills_no_further_than_the_burst(clock):
+    limiter = RateLimiter(2, 0.5)
+    limiter.take('a')
+    clock.now += 3600
+    assert [limiter.take('a'), limiter.take('a')] == [0, 0]
+    assert limiter.take('a') == pytest.approx(2.0)
+
+
+def test_rate_limiter_forgets_the_oldest_keys(clock):
+    limiter = RateLimiter(1, 0.1, max_keys = 2)
+    for key in ('a', 'b', 'c'):
+        limiter.take(key)
+    assert list(limiter.buckets) == ['b', 'c']
+    assert limiter.take('a') == 0
+
+
+def client_at(forum, address):
+    client = forum.app.test_client()
+    client.environ_base['REMOTE_ADDR'] = address
+    return client
+
+
+def login_client(forum, address):
+    with forum.app.app_context():
+        password = forum.bcrypt.generate_password_hash('right-pass' + forum.salt).decode('utf-8')
+        forum.db.session.add(forum.User(name = 'victim', username = 'victim', password = password))
+        forum.db.session.commit()
+    return client_at(forum, address)
+
+
+def test_refused_address_does_not_spend_the_accounts_attempts(forum):
+    client = login_client(forum, '10.0.0.1')
+    for _ in range(forum.app.config['LOGIN_IP_BURST']):
+        client.post('/login', data = {'username': 'someone', 'password': 'wrong-pass'})
+    rv = client.post('/login', data = {'username': 'victim', 'password': 'wrong-pass'})
+    assert rv.status_code == 429
+    assert int(rv.headers['Retry-After']) >= 1
+    assert 'victim' not in forum.login_user_limit.buckets
+
+    # the account's own attempts are intact for everyone else
+    other = client_at(forum, '10.0.0.2')
+    rv = other.post('/login', data = {'username': 'victim', 'password': 'right-pass'})
+    assert rv.status_code == 302
+
+
+def test_account_limit_applies_across_addresses(forum):
+    login_client(forum, '10.0.0.1')
+    for i in range(forum.app.config['LOGIN_USER_BURST']):
+        client = client_at(forum, '10.0.1.%d' % i)
+        assert client.post('/login', data = {'username': 'victim', 'password': 'wrong-pass'}).status_code == 200
+    client = client_at(forum, '10.0.2.1')
+    rv = client.post('/login', data = {'username': 'Victim', 'password': 'right-pass'})
+    assert rv.status_code == 429
+    assert int(rv.headers['Retry-After']) == 30
+
+
+def blocked(pool, release):
+    started = threading.Event()
+    def hash():
+        started.set()
+        release.wait(5)
+        return 'hashed'
+    results = []
+    thread = threading.Thread(target = lambda: results.append(pool.run(hash)))
+    thread.start()
+    assert started.wait(5)
+    return thread, results
+
+
+def test_hash_pool_refuses_at_once_when_full():
+    pool, release = HashPool(1), threading.Event()
+    thread, results = blocked(pool, release)
+    with pytest.raises(HasherBusy):
+        pool.run(len, 'x')
+    release.set()
+    thread.join(5)
+    assert results == ['hashed']
+    assert pool.run(len, 'x') == 1
+
+
+def test_hash_pool_queue_waits_for_a_free_hasher():
+    pool, release = HashPool(1, queue = 1), threading.Event()
+    thread, results = blocked(pool, release)
+    waiting = []
+    queued = threading.Thread(target = lambda: waiting.append(pool.run(len, 'queued')))
+    queued.start()
+    queued.join(0.2)
+    assert queued.is_alive() and not waiting
+    with pytest.raises(HasherBusy):
+        pool.run(len, 'x')
+    release.set()
+    thread.join(5)
+    queued.join(5)
+    assert results == ['hashed'] and waiting == [6]
+
+
+def test_hash_pool_frees_its_slot_when_the_hash_fails():
+    pool = HashPool(1)
+    with pytest.raises(ValueError):
+        pool.run(int, 'not a number')
+    assert pool.run(len, 'x') == 1
+
+
+def test_busy_hasher_turns_login_away(forum, monkeypatch):
+    client = login_client(forum, '10.0.0.1')
+    monkeypatch.setattr(forum, 'hash_pool', HashPool(0))
+    rv = client.post('/login', data = {'username': 'victim', 'password': 'right-pass'})
+    assert rv.status_code == 503
+    assert rv.headers['Retry-After'] == '1'
@@ -0,0 +1,146 @@
+import hashlib
+import io
+
+from PIL import Image
+
+import images
+
+
+def png(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), 'green').save(out, 'PNG')
+    return out.getvalue()
+
+
+def thread(forum):
+    """A question with one reply, plus a client for the person who writes to it
+    and one for someone who only reads it."""
+    with forum.app.app_context():
+        writer = forum.User(name = 'writer', username = 'writer', password = 'x')
+        reader = forum.User(name = 'reader', username = 'reader', password = 'x')
+        question = forum.Post(name = 'writer', posts = 'Which sword is best?')
+        forum.db.session.add_all([writer, reader, question])
+        forum.db.session.flush()
+        reply = forum.Replies(name = 'reader', posts = 'The moonlight one', likes = 0, response = question.id)
+        forum.db.session.add(reply)
+        forum.db.session.commit()
+        ids = writer.id, reader.id, question.id, reply.id
+    clients = []
+    for user_id in ids[:2]:
+        client = forum.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        clients.append(client)
+    return clients[0], clients[1], ids[2], ids[3]
+
+
+def cached_thread(forum, client, question_id):
+    page = client.get('/response/%d' % question_id).data
+    token = forum.fragments.get('thread:%d' % question_id)
+    assert token is not None
+    assert forum.fragments.get('replies:%d:%s' % (question_id, token)) is not None
+    return page, token
+
+
+def test_new_reply_retires_thread_and_feed(forum):
+    writer, reader, question_id, _ = thread(forum)
+    cached_thread(forum, reader, question_id)
+    reader.get('/dashboard')
+    assert forum.fragments.get('feed:gen') is not None
+    writer.post('/response/%d' % question_id, data = {'answer': 'The greatsword'})
+    assert forum.fragments.get('thread:%d' % question_id) is None
+    assert forum.fragments.get('feed:gen') is None
+    assert b'The greatsword' in reader.get('/response/%d' % question_id).data
+
+
+def test_vote_retires_thread(forum):
+    writer, reader, question_id, reply_id = thread(forum)
+    page, _ = cached_thread(forum, reader, question_id)
+    assert b'<p class="commenterLikesNum">0</p>' in page
+    assert writer.post('/upvote/%d/True' % reply_id).get_json()['changed']
+    assert forum.fragments.get('thread:%d' % question_id) is None
+    assert b'<p class="commenterLikesNum">1</p>' in reader.get('/response/%d' % question_id).data
+
+
+def test_repeated_vote_keeps_thread(forum):
+    writer, reader, question_id, reply_id = thread(forum)
+    writer.post('/upvote/%d/True' % reply_id)
+    _, token = cached_thread(forum, reader, question_id)
+    assert not writer.post('/upvote/%d/True' % reply_id).get_json()['changed']
+    assert forum.fragments.get('thread:%d' % question_id) == token
+
+
+def test_image_attach_retires_thread(forum):
+    writer, reader, question_id, reply_id = thread(forum)
+    data = png(600, 400)
+    source = hashlib.sha256(data).hexdigest()
+    display, thumb = images.process(data)
+    cached_thread(forum, reader, question_id)
+    with forum.app.app_context():
+        forum.attach_image(forum.Replies, reply_id, source, display, thumb)
+        digest = forum.db.session.get(forum.Replies, reply_id).thumb
+    assert forum.fragments.get('thread:%d' % question_id) is None
+    assert ('/media/%s' % digest).encode() in reader.get('/response/%d' % question_id).data
+
+    # the same picture on the question reuses the stored blobs without a trip
+    # to the pool, and a question's thumbnail shows in the feed as well
+    cached_thread(forum, reader, question_id)
+    assert ('/media/%s' % digest).encode() not in reader.get('/dashboard').data
+    with forum.app.app_context():
+        forum.queue_image(forum.db.session.get(forum.Post, question_id), data)
+    assert forum.fragments.get('thread:%d' % question_id) is None
+    assert forum.fragments.get('feed:gen') is None
+    assert ('/media/%s' % digest).encode() in reader.get('/dashboard').data
+
+
+def test_new_post_retires_feed(forum):
+    writer, reader, _, _ = thread(forum)
+    assert b'Which sword is best?' in reader.get('/dashboard').data
+    token = forum.fragments.get('feed:gen')
+    writer.post('/dashboard', data = {'askquestion': 'Which shield is best?'})
+    assert forum.fragments.get('feed:gen') is None
+    assert b'Which shield is best?' in reader.get('/dashboard').data
+    assert forum.fragments.get('feed:gen') not in (None, token)
+
+
+def test_render_overtaken_by_a_write_is_never_served(forum, monkeypatch):
+    writer, reader, question_id, _ = thread(forum)
+    render_replies = forum.render_replies
+
+    # a reply lands between reading the rows and storing the fragment, so the
+    # render stores what the thread looked like before it
+    def overtaken(question_id):
+        html = render_replies(question_id)
+        monkeypatch.setattr(forum, 'render_replies', render_replies)
+        writer.post('/response/%d' % question_id, data = {'answer': 'Written mid-render'})
+        return html
+
+    monkeypatch.setattr(forum, 'render_replies', overtaken)
+    assert b'Written mid-render' not in reader.get('/response/%d' % question_id).data
+    for _ in range(3):
+        assert b'Written mid-render' in reader.get('/response/%d' % question_id).data
+
+
+def test_stale_set_under_old_token_is_never_served(forum):
+    writer, reader, question_id, _ = thread(forum)
+    _, token = cached_thread(forum, reader, question_id)
+    writer.post('/response/%d' % question_id, data = {'answer': 'The greatsword'})
+    forum.fragments.set('replies:%d:%s' % (question_id, token), 'stale replies')
+    page = reader.get('/response/%d' % question_id).data
+    assert b'stale replies' not in page
+    assert b'The greatsword' in page
+
+
+def test_writer_sees_own_reply_before_other_workers_catch_up(forum):
+    writer, reader, question_id, _ = thread(forum)
+    _, token = cached_thread(forum, reader, question_id)
+    keys = ['thread:%d' % question_id, 'question:%d:%s' % (question_id, token), 'replies:%d:%s' % (question_id, token)]
+    before = [forum.fragments.get(key) for key in keys]
+    rv = writer.post('/response/%d' % question_id, data = {'answer': 'The greatsword'}, follow_redirects = False)
+
+    # another worker's in-process cache never heard about the write; readers
+    # there get the old thread until it expires, the writer does not
+    for key, value in zip(keys, before):
+        forum.fragments.set(key, value)
+    assert b'The greatsword' not in reader.get(rv.headers['Location']).data
+    assert b'The greatsword' in writer.get(rv.headers['Location']).data
@@ -0,0 +1,44 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(args, database):
+    env = dict(os.environ, DATABASE_URL = 'sqlite:///' + database, REQUIRE_CURRENT_SCHEMA = '1')
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    return subprocess.run(args, cwd = ROOT, env = env, capture_output = True, text = True, timeout = 120)
+
+
+def test_serving_the_shipped_database_needs_an_upgrade_first(tmp_path):
+    database = str(tmp_path / 'db.sqlite')
+    shutil.copy(os.path.join(ROOT, 'db.sqlite'), database)
+    refused = run([sys.executable, '-c', 'import app'], database)
+    assert refused.returncode != 0
+    assert 'SchemaOutOfDate' in refused.stderr
+    assert 'flask --app app upgrade-db' in refused.stderr
+
+    upgraded = run([sys.executable, '-m', 'flask', '--app', 'app', 'upgrade-db'], database)
+    assert upgraded.returncode == 0, upgraded.stderr
+    assert 'Applied migration 7: answer cache' in upgraded.stdout
+
+    assert run([sys.executable, '-c', 'import app'], database).returncode == 0
+    again = run([sys.executable, '-m', 'flask', '--app', 'app', 'upgrade-db'], database)
+    assert again.returncode == 0 and again.stdout == ''
+
+
+def test_a_missing_migration_is_reported(forum):
+    with forum.app.app_context():
+        forum.require_current_schema()
+        forum.db.session.execute(forum.db.text("DELETE FROM schema_migrations WHERE version = 7"))
+        forum.db.session.commit()
+        try:
+            with pytest.raises(forum.SchemaOutOfDate, match = 'missing migrations 7'):
+                forum.require_current_schema()
+        finally:
+            forum.upgrade_schema()
+        forum.require_current_schema()
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import itertools
+
+from PIL import Image
+import pytest
+
+from cache import NullCache
+import images
+
+names = itertools.count()
+
+
+@pytest.fixture
+def budgets(forum, monkeypatch):
+    monkeypatch.setitem(forum.app.config, 'ENFORCE_QUERY_BUDGETS', True)
+    monkeypatch.setitem(forum.app.config, 'PROFILE_REQUESTS', True)
+    # small enough that ten questions still fill a second page of results
+    monkeypatch.setitem(forum.app.config, 'SEARCH_PAGE_SIZE', 5)
+    # every view below has to pay for its queries; a cached fragment would hide them
+    monkeypatch.setattr(forum, 'fragments', NullCache())
+    return forum
+
+
+def grow(forum, total):
+    """Brings the forum to `total` questions, each with three replies, a vote on
+    every reply and an image, and returns the ids the routes need."""
+    with forum.app.app_context():
+        db = forum.db
+        if forum.User.query.count() == 0:
+            password = forum.bcrypt.generate_password_hash('budget-pass' + forum.salt).decode('utf-8')
+            db.session.add_all([forum.User(name = 'budget%d' % i, username = 'budget%d' % i, password = password) for i in range(2)])
+            out = io.BytesIO()
+            Image.new('RGB', (600, 400), 'blue').save(out, 'PNG')
+            display, thumb = images.process(out.getvalue())
+            source = hashlib.sha256(out.getvalue()).hexdigest()
+            forum.store_blob(display, 'display', source)
+            forum.store_blob(thumb, 'thumb', source)
+            db.session.commit()
+        voter, reader = [user.id for user in forum.User.query.order_by(forum.User.id).limit(2)]
+        display, thumb = [blob.sha256 for blob in forum.Blob.query.order_by(forum.Blob.kind)]
+        for i in range(forum.Post.query.count(), total):
+            post = forum.Post(name = 'budget0', posts = 'budget question %d about dragons' % i, image = display, thumb = thumb)
+            db.session.add(post)
+            db.session.flush()
+            replies = [forum.Replies(name = 'budget0', posts = 'dragon reply %d' % j, likes = 1, response = post.id,
+                                     image = display, thumb = thumb) for j in range(3)]
+            db.session.add_all(replies)
+            db.session.flush()
+            db.session.add_all([forum.Vote(user_id = voter, replies_id = reply.id, choice = 'True') for reply in replies])
+        db.session.commit()
+        newest = forum.Post.query.order_by(forum.Post.id.desc()).first()
+        unvoted = forum.Replies.query.filter_by(response = newest.id).first()
+        return {'user': reader, 'post': newest.id, 'middle': newest.id // 2, 'reply': unvoted.id, 'thumb': thumb}
+
+
+def register(ids):
+    name = 'newbie%d' % next(names)
+    return [('GET', '/register', None), ('POST', '/register', {'name': name, 'username': name, 'password': 'pass1234'})]
+
+
+def login(ids):
+    return [('GET', '/login', None), ('POST', '/login', {'username': 'budget1', 'password': 'budget-pass'})]
+
+
+def dashboard(ids):
+    return [('GET', '/dashboard', None), ('GET', '/dashboard?limit=100', None), ('GET', '/dashboard?before=%d' % ids['middle'], None),
+            ('GET', '/dashboard?format=json', None), ('POST', '/dashboard', {'askquestion': 'one more question'})]
+
+
+def response(ids):
+    return [('GET', '/response/%d' % ids['post'], None), ('POST', '/response/%d' % ids['post'], {'answer': 'one more reply'})]
+
+
+def answer(ids):
+    return [('GET', '/answer/%d' % ids['post'], None)]
+
+
+def media(ids):
+    return [('GET', '/media/%s' % ids['thumb'], None)]
+
+
+def upvote(ids):
+    return [('POST', '/upvote/%d/True' % ids['reply'], None), ('POST', '/upvote/%d/True' % ids['reply'], None),
+            ('GET', '/upvote/%d/False' % ids['reply'], None)]
+
+
+def find(ids):
+    return [('GET', '/find?filtered=dragons', None), ('GET', '/find?filtered=dragon+reply', None), ('GET', '/find?filtered=dragons+budget&page=2', None),
+            ('POST', '/find', {'filtered': 'budget question'})]
+
+
+def query_counts(forum, ids, steps):
+    client = forum.app.test_client()
+    if steps not in (register, login):
+        with client.session_transaction() as session:
+            session['_user_id'] = str(ids['user'])
+    counts = []
+    for method, url, data in steps(ids):
+        rv = client.open(url, method = method, data = data)
+        assert rv.status_code < 400, (method, url, rv.status_code)
+        counts.append(int(rv.headers['X-Query-Count']))
+    return counts
+
+
+@pytest.mark.parametrize('steps', [register, login, dashboard, response, answer, media, upvote, find])
+def test_query_count_does_not_grow_with_the_data(budgets, steps):
+    small = query_counts(budgets, grow(budgets, 10), steps)
+    large = query_counts(budgets, grow(budgets, 500), steps)
+    assert small == large
+
+
+def test_going_over_budget_raises(budgets, monkeypatch):
+    ids = grow(budgets, 10)
+    monkeypatch.setattr(budgets.app.view_functions['media'], 'query_budget', 0)
+    with pytest.raises(budgets.QueryBudgetExceeded, match = 'media ran 2 queries, budget is 0'):
+        query_counts(budgets, ids, media)
+
+
+def test_going_over_budget_only_warns_unless_enforced(budgets, monkeypatch, caplog):
+    ids = grow(budgets, 10)
+    monkeypatch.setitem(budgets.app.config, 'ENFORCE_QUERY_BUDGETS', False)
+    monkeypatch.setattr(budgets.app.view_functions['media'], 'query_budget', 0)
+    assert query_counts(budgets, ids, media) == [2]
+    assert 'media ran 2 queries, budget is 0' in caplog.text
@@ -0,0 +1,96 @@
+import pytest
+
+
+def thread(forum, question, *replies):
+    with forum.app.app_context():
+        post = forum.Post(name = 'asker', posts = question)
+        forum.db.session.add(post)
+        forum.db.session.flush()
+        rows = [forum.Replies(name = 'helper', posts = text, likes = 0, response = post.id) for text in replies]
+        forum.db.session.add_all(rows)
+        forum.db.session.commit()
+        return post.id, [row.id for row in rows]
+
+
+def found(forum, text, page = 1, limit = 20):
+    with forum.app.app_context():
+        preguntas, snippets, more = forum.search_posts(text, page, limit)
+        return [post.id for post in preguntas], more
+
+
+def test_terms_can_match_across_question_and_replies(forum):
+    post_id, reply_ids = thread(forum, 'how to beat malenia', 'use bleed', 'summon the jellyfish')
+    other_id, other_replies = thread(forum, 'malenia is too hard')
+    assert found(forum, 'malenia bleed') == ([post_id], False)
+    assert found(forum, 'bleed jellyfish') == ([post_id], False)
+    assert sorted(found(forum, 'malenia')[0]) == sorted([post_id, other_id])
+    assert found(forum, 'malenia frost') == ([], False)
+
+
+def test_every_term_has_to_match_somewhere(forum):
+    thread(forum, 'where is the elden ring', 'in the erdtree')
+    assert found(forum, 'elden erdtree dragon') == ([], False)
+
+
+def test_find_highlights_the_best_row(forum):
+    post_id, reply_ids = thread(forum, 'how to beat malenia', 'use bleed')
+    with forum.app.app_context():
+        user = forum.User(name = 'searcher', username = 'searcher', password = 'x')
+        forum.db.session.add(user)
+        forum.db.session.commit()
+        user_id = user.id
+    client = forum.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    rv = client.get('/find?filtered=malenia+bleed')
+    assert rv.status_code == 200
+    assert b'<mark>' in rv.data
+    assert ('/response/%d' % post_id).encode() in rv.data
+
+
+def test_triggers_follow_inserts_updates_and_deletes(forum):
+    post_id, (reply_id,) = thread(forum, 'grafted scion tips', 'roll to the left')
+    other_id, other_replies = thread(forum, 'margit tips')
+    assert found(forum, 'roll')[0] == [post_id]
+    with forum.app.app_context():
+        db = forum.db
+        db.session.get(forum.Post, post_id).posts = 'godrick tips'
+        db.session.commit()
+        assert found(forum, 'grafted')[0] == []
+        assert found(forum, 'godrick')[0] == [post_id]
+        db.session.get(forum.Replies, reply_id).response = other_id
+        db.session.commit()
+        assert found(forum, 'roll')[0] == [other_id]
+        db.session.delete(db.session.get(forum.Replies, reply_id))
+        db.session.commit()
+        assert found(forum, 'roll')[0] == []
+        db.session.delete(db.session.get(forum.Post, post_id))
+        db.session.commit()
+        assert found(forum, 'godrick')[0] == []
+
+
+def test_rebuild_search_backfills_the_index(forum):
+    post_id, reply_ids = thread(forum, 'how to beat malenia', 'use bleed')
+    with forum.app.app_context():
+        forum.db.session.execute(forum.db.text('DELETE FROM search_index'))
+        forum.db.session.commit()
+    assert found(forum, 'bleed')[0] == []
+    result = forum.app.test_cli_runner().invoke(args = ['rebuild-search'])
+    assert result.exit_code == 0
+    assert 'Search index rebuilt.' in result.output
+    assert found(forum, 'malenia bleed')[0] == [post_id]
+
+
+def test_pages_cover_every_match_once(forum):
+    ids = [thread(forum, 'dragon question %d' % i)[0] for i in range(45)]
+    thread(forum, 'nothing to see here')
+    pages = [found(forum, 'dragon', page = page) for page in (1, 2, 3, 4)]
+    assert [len(page) for page, more in pages] == [20, 20, 5, 0]
+    assert [more for page, more in pages] == [True, True, False, False]
+    assert sorted(sum([page for page, more in pages], [])) == sorted(ids)
+
+
+@pytest.mark.parametrize('text', ['"OR', 'NEAR(', 'a* -b', '', '   ', '^^^'])
+def test_user_input_is_never_fts_syntax(forum, text):
+    thread(forum, 'a question')
+    found(forum, text)
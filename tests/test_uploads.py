@@ -0,0 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import time
+
+from PIL import Image
+
+import images
+
+
+def png(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), 'red').save(out, 'PNG')
+    return out.getvalue()
+
+
+def client_for(forum):
+    with forum.app.app_context():
+        user = forum.User(name = 'uploader', username = 'uploader', password = 'x')
+        question = forum.Post(name = 'uploader', posts = 'Look at this')
+        forum.db.session.add_all([user, question])
+        forum.db.session.commit()
+        user_id, question_id = user.id, question.id
+    client = forum.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    return client, question_id
+
+
+def test_body_over_max_content_length_flashes_and_redirects(forum):
+    client, question_id = client_for(forum)
+    too_big = b'0' * (forum.app.config['MAX_CONTENT_LENGTH'] + 1)
+    for url, field in (('/dashboard', 'askquestion'), ('/response/%d' % question_id, 'answer')):
+        rv = client.post(url, data = {field: 'x', 'imageFile': (io.BytesIO(too_big), 'a.png')})
+        assert rv.status_code == 302
+        assert rv.headers['Location'] == url
+        assert b'Uploads must be smaller than 16 MB.' in client.get(url).data
+
+
+def test_image_over_max_image_bytes_is_flashed(forum):
+    client, question_id = client_for(forum)
+    forum.app.config['MAX_IMAGE_BYTES'] = 1024
+    try:
+        rv = client.post('/dashboard', data = {'askquestion': 'x', 'imageFile': (io.BytesIO(png(200, 200) + b'0' * 2048), 'a.png')})
+    finally:
+        forum.app.config['MAX_IMAGE_BYTES'] = 8 * 1024 * 1024
+    assert rv.status_code == 302
+    assert b'Images must be smaller than' in client.get('/dashboard').data
+
+
+def test_upload_is_resized_off_the_request(forum):
+    client, question_id = client_for(forum)
+    rv = client.post('/dashboard', data = {'askquestion': 'with a picture', 'imageFile': (io.BytesIO(png(3000, 2000)), 'a.png')})
+    assert rv.status_code == 302
+    deadline = time.time() + 30
+    while True:
+        post = client.get('/dashboard?format=json').json['posts'][0]
+        if post['thumb'] or time.time() > deadline:
+            break
+        time.sleep(0.1)
+    assert post['posts'] == 'with a picture'
+    thumb = client.get(post['thumb'])
+    assert thumb.status_code == 200
+    assert Image.open(io.BytesIO(thumb.data)).size == (300, 200)
+
+
+def test_images_process_in_a_spawned_worker():
+    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as pool:
+        display, thumb = pool.submit(images.process, png(3000, 2000)).result(timeout = 60)
+    assert (display.width, display.height) == (1280, 853)
+    assert (thumb.width, thumb.height) == (300, 200)
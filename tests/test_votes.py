@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import random
+
+SCORE = "SELECT COALESCE(SUM(CASE choice WHEN 'True' THEN 1 WHEN 'False' THEN -1 ELSE 0 END), 0) FROM vote WHERE replies_id = :reply"
+
+
+def seed(forum, users, replies):
+    with forum.app.app_context():
+        people = [forum.User(name = 'voter%d' % i, username = 'voter%d' % i, password = 'x') for i in range(users)]
+        question = forum.Post(name = 'voter0', posts = 'Which answer is right?')
+        forum.db.session.add_all(people + [question])
+        forum.db.session.flush()
+        answers = [forum.Replies(name = 'voter0', posts = 'answer %d' % i, likes = 0, response = question.id) for i in range(replies)]
+        forum.db.session.add_all(answers)
+        forum.db.session.commit()
+        return [user.id for user in people], [reply.id for reply in answers]
+
+
+def vote(forum, user_id, reply_id, choice):
+    with forum.app.app_context():
+        return forum.cast_vote(user_id, reply_id, choice)
+
+
+def run_votes(forum, jobs):
+    with ThreadPoolExecutor(max_workers = 12) as pool:
+        return list(pool.map(lambda job: vote(forum, *job), jobs))
+
+
+def scores(forum, reply_ids):
+    with forum.app.app_context():
+        rows = forum.db.session.query(forum.Replies.id, forum.Replies.likes).filter(forum.Replies.id.in_(reply_ids))
+        return dict(rows.all())
+
+
+def test_parallel_repeated_votes_count_once(forum):
+    user_ids, reply_ids = seed(forum, 50, 10)
+    # every user fires the same vote five times at once; only one of them may
+    # count, so each reply ends at exactly upvoters - downvoters
+    choices = {user_id: 'True' if i % 3 else 'False' for i, user_id in enumerate(user_ids)}
+    jobs = [(user_id, reply_id, choices[user_id]) for user_id in user_ids for reply_id in reply_ids] * 5
+    random.shuffle(jobs)
+    results = run_votes(forum, jobs)
+    expected = sum(1 if choice == 'True' else -1 for choice in choices.values())
+    assert scores(forum, reply_ids) == {reply_id: expected for reply_id in reply_ids}
+    assert sum(changed for changed, likes in results) == len(user_ids) * len(reply_ids)
+    with forum.app.app_context():
+        assert forum.Vote.query.count() == len(user_ids) * len(reply_ids)
+
+
+def test_parallel_mixed_votes_match_vote_rows(forum):
+    user_ids, reply_ids = seed(forum, 20, 5)
+    jobs = [(random.choice(user_ids), random.choice(reply_ids), random.choice(['True', 'False'])) for i in range(3000)]
+    run_votes(forum, jobs)
+    with forum.app.app_context():
+        for reply_id, likes in scores(forum, reply_ids).items():
+            assert likes == forum.db.session.execute(forum.db.text(SCORE), {'reply': reply_id}).scalar()
+        pairs = forum.db.session.query(forum.Vote.user_id, forum.Vote.replies_id).all()
+        assert len(pairs) == len(set(pairs))
+
+
+def test_vote_steps_towards_the_other_arrow(forum):
+    (user_id,), (reply_id,) = seed(forum, 1, 1)
+    steps = [vote(forum, user_id, reply_id, choice) for choice in ('True', 'True', 'False', 'False', 'False', 'True')]
+    assert steps == [(True, 1), (False, 1), (True, 0), (True, -1), (False, -1), (True, 0)]
+
+
+def test_unique_votes_migration_recounts_scores(forum):
+    user_ids, reply_ids = seed(forum, 2, 2)
+    with forum.app.app_context():
+        db = forum.db
+        db.session.execute(db.text("DROP INDEX ix_vote_user_reply"))
+        db.session.add_all([
+            forum.Vote(user_id = user_ids[0], replies_id = reply_ids[0], choice = 'True'),
+            forum.Vote(user_id = user_ids[0], replies_id = reply_ids[0], choice = 'True'),
+            forum.Vote(user_id = user_ids[0], replies_id = reply_ids[0], choice = 'False'),
+            forum.Vote(user_id = user_ids[1], replies_id = reply_ids[0], choice = 'True'),
+            forum.Vote(user_id = user_ids[1], replies_id = reply_ids[1], choice = 'False'),
+            forum.Vote(user_id = user_ids[1], replies_id = reply_ids[1], choice = 'False'),
+        ])
+        db.session.execute(db.update(forum.Replies).values(likes = 7))
+        db.session.commit()
+        forum.unique_votes()
+        db.session.commit()
+        assert forum.Vote.query.count() == 3
+    assert scores(forum, reply_ids) == {reply_ids[0]: 0, reply_ids[1]: -1}